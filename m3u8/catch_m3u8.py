@@ -1,11 +1,13 @@
 import os
+import time
+import hashlib
 import requests
 import argparse
 from m3u8 import M3U8
 import multiprocessing
 import shutil
 import util
-from util import getResponse
+from util import getResponse, checkResponse, checkSegmentFile, isValidSegment
 
 CRYPTO_ENABLE = True
 try:
@@ -15,7 +17,7 @@ except ImportError as e:
     print('Import Crypto error!')
 
 
-def downloadTsFiles(ts_list, tmp_dir, process_id):
+def downloadTsFiles(ts_list, tmp_dir, process_id, encrypted=False):
     cookies = None
     session = requests.Session()
     for i, ts_url in enumerate(ts_list):
@@ -23,16 +25,57 @@ def downloadTsFiles(ts_list, tmp_dir, process_id):
         retry_times = 100
         tmp_file = os.path.join(tmp_dir, ts_url.rsplit('/', 1)[-1])
         if os.path.exists(tmp_file):
-            continue
+            with open(tmp_file, 'rb') as f:
+                if isValidSegment(f.read(), encrypted):
+                    continue
 
+        retry_delay = util.RETRY_DELAY
+        last_invalid = None
+        same_invalid_times = 0
         while retry_times > 0:
-            ret_sucess, cookies = downloadTs(ts_url, tmp_file, session, cookies)
+            ret_sucess, cookies, invalid_key = downloadTs(ts_url, tmp_file, session, cookies, encrypted)
             retry_times -= 1
             if ret_sucess:
                 break
 
+            # 同样的无效响应反复出现（如错误页面、认证页面），不再重试
+            if invalid_key is not None and invalid_key == last_invalid:
+                same_invalid_times += 1
+            else:
+                same_invalid_times = 1 if invalid_key is not None else 0
+            last_invalid = invalid_key
+            if same_invalid_times >= util.MAX_SAME_INVALID_TIMES:
+                print('Same invalid response for %d times, skip %s' % (same_invalid_times, ts_url))
+                break
+
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, util.MAX_RETRY_DELAY)
+
+
+def downloadTsParallel(ts_urls, tmp_dir, process_num, encrypted=False):
+    ts_len = len(ts_urls)
+    process_num = max(1, min(process_num, ts_len))
+    process_list = []
+    per_process_num = int(ts_len / process_num)
+
+    # 启用多进程下载视频
+    for i in range(process_num):
+        id_start = i * per_process_num
+        id_end = (i + 1) * per_process_num
+        if i == process_num - 1:
+            id_end = ts_len
+        cur_process = multiprocessing.Process(
+            target=downloadTsFiles, args=(ts_urls[id_start:id_end], tmp_dir, i, encrypted))
+        cur_process.start()
+        # search_ip(ip_prefix, database, table_name, ip_start, ip_end, i)
+        process_list.append(cur_process)
 
-def downloadTs(ts_url, tmp_file, session, cookies=None):
+    for process_item in process_list:
+        process_item.join()
+
+
+def downloadTs(ts_url, tmp_file, session, cookies=None, encrypted=False):
+    # 返回是否成功、cookies，以及无效响应的标识（原因与内容摘要），用于判断是否反复收到同样的错误页面
     try:
         resp = session.get(
             ts_url,
@@ -43,12 +86,21 @@ def downloadTs(ts_url, tmp_file, session, cookies=None):
         if cookies is None:
             cookies = session.cookies
 
-        with open(tmp_file, 'wb') as f:
+        # 错误页面或不完整的片段不保存，稍后重试
+        ret_valid, reason = checkResponse(resp, encrypted)
+        if not ret_valid:
+            print('Invalid segment %s, %s' % (ts_url, reason))
+            return False, cookies, (reason, hashlib.md5(resp.content).hexdigest())
+
+        # 先写入临时文件，避免中断时留下不完整的片段
+        part_file = tmp_file + '.part'
+        with open(part_file, 'wb') as f:
             f.write(resp.content)
-        return True, cookies
+        os.replace(part_file, tmp_file)
+        return True, cookies, None
     except Exception as e:
         Warning('Error:%s' % str(e))
-        return False, cookies
+        return False, cookies, None
         # raise ConnectionError('Error:%s' % str(e))
 
 
@@ -81,29 +133,30 @@ def downM3u8Video(url, out_dir, out_name, process_num):
 
     m3u8_info = M3U8(url)
     ts_len = len(m3u8_info.ts_urls)
+    # 只有 AES-128 加密整个片段，SAMPLE-AES 等方式的片段仍是 TS/fMP4 格式
+    encrypted = m3u8_info.encrypt_method is not None and m3u8_info.encrypt_method.strip() == 'AES-128'
     print('ts length:%d' % ts_len)
 
     if ts_len > 0:
         if not os.path.exists(tmp_dir):
             os.makedirs(tmp_dir)
 
-        process_list = []
-        per_process_num = int(ts_len / process_num)
-
-        # 启用多进程下载视频
-        for i in range(process_num):
-            id_start = i * per_process_num
-            id_end = (i + 1) * per_process_num
-            if i == process_num - 1:
-                id_end = ts_len
-            cur_process = multiprocessing.Process(
-                target=downloadTsFiles, args=(m3u8_info.ts_urls[id_start:id_end], tmp_dir, i))
-            cur_process.start()
-            # search_ip(ip_prefix, database, table_name, ip_start, ip_end, i)
-            process_list.append(cur_process)
-
-        for process_item in process_list:
-            process_item.join()
+        downloadTsParallel(m3u8_info.ts_urls, tmp_dir, process_num, encrypted)
+
+        # 合并前快速检查片段，重新下载无效的片段
+        invalid_urls = []
+        for ts_url in m3u8_info.ts_urls:
+            tmp_file = os.path.join(tmp_dir, ts_url.rsplit('/', 1)[-1])
+            if not checkSegmentFile(tmp_file, encrypted):
+                invalid_urls.append(ts_url)
+        if invalid_urls:
+            print('%d segments are invalid, download again' % len(invalid_urls))
+            downloadTsParallel(invalid_urls, tmp_dir, process_num, encrypted)
+            for ts_url in invalid_urls:
+                tmp_file = os.path.join(tmp_dir, ts_url.rsplit('/', 1)[-1])
+                if not checkSegmentFile(tmp_file, encrypted):
+                    print('Some files fail to download, try again!')
+                    return
 
         # 若有加密，尝试解密文件
         if CRYPTO_ENABLE and m3u8_info.encrypt_method:
@@ -1,6 +1,10 @@
+import os
 import requests
 
 TIMEOUT = 10
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+MAX_SAME_INVALID_TIMES = 5
 HEADERS = {
     "User-Agent":
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_5) \
@@ -27,3 +31,76 @@ def getM3u8File(url):
     m3u8_lines = m3u8_content.split('\n')
     # print(m3u8_lines)
     return m3u8_lines
+
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+AES_BLOCK_SIZE = 16
+MP4_BOX_TYPES = [b'ftyp', b'styp', b'sidx', b'moof', b'mdat', b'moov', b'emsg', b'prft', b'free', b'skip']
+
+
+def isValidTs(content):
+    # MPEG-TS 由 188 字节的包组成，每个包以同步字节 0x47 开头
+    packet_num = len(content) // TS_PACKET_SIZE
+    if packet_num == 0 or len(content) % TS_PACKET_SIZE != 0:
+        return False
+    return content[::TS_PACKET_SIZE].count(TS_SYNC_BYTE) == packet_num
+
+
+def isValidMp4(content):
+    # fMP4 由连续的 box 组成，box 头为 4 字节长度 + 4 字节类型，长度需恰好覆盖全部内容
+    if len(content) < 8 or content[4:8] not in MP4_BOX_TYPES:
+        return False
+    offset = 0
+    while offset < len(content):
+        if len(content) - offset < 8:
+            return False
+        box_size = int.from_bytes(content[offset:offset + 4], 'big')
+        if box_size == 1:
+            if len(content) - offset < 16:
+                return False
+            box_size = int.from_bytes(content[offset + 8:offset + 16], 'big')
+        elif box_size == 0:
+            box_size = len(content) - offset
+        if box_size < 8:
+            return False
+        offset += box_size
+    return offset == len(content)
+
+
+def isValidSegment(content, encrypted=False):
+    if not content:
+        return False
+    if encrypted:
+        # 加密的片段无法检查内容，只检查是否为完整的 AES 块
+        return len(content) % AES_BLOCK_SIZE == 0
+    return isValidTs(content) or isValidMp4(content)
+
+
+def checkResponse(resp, encrypted=False):
+    # 检查状态码、长度与片段内容，避免将错误页面或截断的内容保存为 ts 文件
+    if resp.status_code != 200:
+        return False, 'status code %d' % resp.status_code
+    content_length = resp.headers.get('Content-Length')
+    if content_length is not None and 'Content-Encoding' not in resp.headers:
+        if int(content_length) != len(resp.content):
+            return False, 'content length %d, expected %s' % (len(resp.content), content_length)
+    if not isValidSegment(resp.content, encrypted):
+        return False, 'invalid segment content'
+    return True, None
+
+
+def checkSegmentFile(file_path, encrypted=False):
+    # 合并前的快速检查，只读取文件头
+    if not os.path.exists(file_path):
+        return False
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return False
+    if encrypted:
+        return file_size % AES_BLOCK_SIZE == 0
+    with open(file_path, 'rb') as f:
+        header = f.read(8)
+    if header[0] == TS_SYNC_BYTE and file_size % TS_PACKET_SIZE == 0:
+        return True
+    return header[4:8] in MP4_BOX_TYPES
@@ -1,7 +1,12 @@
 import os
+import io
+import re
+import csv
 import time
 import argparse
 import shutil
+import threading
+from collections import OrderedDict
 from comtypes.client import CreateObject
 from tqdm import tqdm
 from reportlab.pdfgen import canvas
@@ -10,6 +15,8 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib import colors
 from pypdf import PdfFileReader, PdfFileWriter
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 TRY_TIMES = 3
 DEFAULT_FONT_SIZE_SCALE = 0.04
@@ -21,6 +28,18 @@ ORGIN_LIST = [
     (0.7, 0.3),
 ]
 
+# fonts already registered in reportlab, real path of font file -> font name, reused by long-running processes
+REGISTERED_FONTS = {}
+FONT_LOCK = threading.Lock()
+KEY_FILE_LOCK = threading.Lock()
+# rendered watermark pdf content, keyed by the watermark attributes
+WM_CACHE = OrderedDict()
+WM_CACHE_SIZE = 64
+WM_CACHE_LOCK = threading.Lock()
+# pdf content read by the stamp worker processes, keyed by (path, mtime, size)
+PDF_DATA_CACHE = OrderedDict()
+PDF_DATA_CACHE_SIZE = 2
+
 
 class PdfConvert(object):
 
@@ -40,14 +59,14 @@ class PdfConvert(object):
         if self.pptApp:
             self.pptApp.Quit()
 
-    def run_convert(self, in_file, save_dir):
+    def run_convert(self, in_file, save_dir, force=False):
         file_ext = os.path.splitext(os.path.basename(in_file))[1]
         pdf_file = in_file.replace(file_ext, '.pdf')
         pdf_file = os.path.join(save_dir, os.path.basename(pdf_file))
 
         out_file = pdf_file
         file_ext = file_ext.lower()
-        if not os.path.exists(pdf_file) or file_ext in ['.xls', '.xlsx']:
+        if force or not os.path.exists(pdf_file) or file_ext in ['.xls', '.xlsx']:
             if file_ext in ['.doc', '.docx']:
                 out_file = self.word2pdf(in_file, pdf_file)
             elif file_ext in ['.ppt', '.pptx']:
@@ -178,8 +197,14 @@ def create_watermark(content='None',
         available_fonts = pdfmetrics.getRegisteredFontNames()
         font_name = available_fonts[0]
     else:
-        font_name = os.path.splitext(os.path.basename(font_file))[0]
-        pdfmetrics.registerFont(TTFont(font_name, font_file))  # register custom font
+        font_path = os.path.normcase(os.path.realpath(font_file))
+        with FONT_LOCK:
+            if font_path not in REGISTERED_FONTS:
+                # fonts with the same file name in different directories get different names
+                font_name = '%s_%d' % (os.path.splitext(os.path.basename(font_file))[0], len(REGISTERED_FONTS))
+                pdfmetrics.registerFont(TTFont(font_name, font_file))  # register custom font
+                REGISTERED_FONTS[font_path] = font_name
+            font_name = REGISTERED_FONTS[font_path]
 
     c = canvas.Canvas(wm_file, pagesize=pagesize)  # create an empty pdf file
 
@@ -188,7 +213,7 @@ def create_watermark(content='None',
     if font_size is None:
         font_size = max(w, h) * DEFAULT_FONT_SIZE_SCALE
     c.setFont(font_name, font_size)
-    c.setFillColor(eval('colors.%s' % color))
+    c.setFillColor(getattr(colors, color))
     c.setFillAlpha(alpha)
     c.saveState()
 
@@ -209,9 +234,42 @@ def create_watermark(content='None',
     return wm_file
 
 
-def merge_watermark(pdf_file, save_dir, owner_pwd, p_value, wm_attrs):
-    out_file = os.path.join(save_dir, os.path.basename(pdf_file))
+def is_valid_color(color):
+    return isinstance(color, str) and isinstance(getattr(colors, color, None), colors.Color)
+
+
+def get_watermark_data(wm_attrs):
+    """
+    return the content of the watermark pdf file, the same watermark is only rendered once
+    """
+    pagesize = wm_attrs['pagesize']
+    font_file = wm_attrs['font_file']
+    if font_file is not None:
+        font_file = os.path.normcase(os.path.realpath(font_file))
+    wm_key = (wm_attrs['content'], float(pagesize[0]), float(pagesize[1]), font_file,
+              wm_attrs['font_size'], wm_attrs['color'], wm_attrs['alpha'], wm_attrs['angle'])
+    with WM_CACHE_LOCK:
+        if wm_key in WM_CACHE:
+            WM_CACHE.move_to_end(wm_key)
+            return WM_CACHE[wm_key]
+
+    wm_file = create_watermark(**wm_attrs)
+    with open(wm_file, 'rb') as f:
+        wm_data = f.read()
+    if os.path.exists(wm_file):
+        os.remove(wm_file)
+
+    with WM_CACHE_LOCK:
+        WM_CACHE[wm_key] = wm_data
+        if len(WM_CACHE) > WM_CACHE_SIZE:
+            WM_CACHE.popitem(last=False)
+    return wm_data
 
+
+def load_pdf(pdf_file):
+    """
+    read the pdf file, try to repair it when failed
+    """
     try:
         pdf_reader = PdfFileReader(pdf_file)
     except Exception as e:
@@ -224,6 +282,31 @@ def merge_watermark(pdf_file, save_dir, owner_pwd, p_value, wm_attrs):
         shutil.move(repair_pdf_file, pdf_file)
         pdf_reader = PdfFileReader(pdf_file)
 
+    return pdf_reader
+
+
+def need_encrypt(owner_pwd):
+    return owner_pwd.lower() not in ['-1', 'no', 'none', 'null']
+
+
+def write_permission_key(key_file, out_file, owner_pwd):
+    with KEY_FILE_LOCK:
+        old_keys = None
+        if os.path.exists(key_file):
+            old_key_file = open(key_file, 'r', encoding='utf-8')
+            old_keys = old_key_file.readlines()
+            old_key_file.close()
+
+        with open(key_file, 'w', encoding='utf-8') as f_log:
+            if old_keys is not None:
+                f_log.writelines(old_keys[-1000:])
+            f_log.write('%s %s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), os.path.relpath(out_file), owner_pwd))
+
+
+def stamp_pdf(pdf_reader, out_file, owner_pwd, p_value, wm_attrs):
+    """
+    merge the watermark into every page of pdf_reader and save to out_file, the pages of pdf_reader are modified
+    """
     if pdf_reader.isEncrypted:
         pdf_reader.decrypt('')
     pdf_writer = PdfFileWriter(out_file)
@@ -233,9 +316,9 @@ def merge_watermark(pdf_file, save_dir, owner_pwd, p_value, wm_attrs):
     page_height = first_page.mediaBox.getHeight()
 
     wm_attrs.update({'pagesize': (page_width, page_height)})
-    wm_file = create_watermark(**wm_attrs)  # for Portrait
+    wm_data = get_watermark_data(wm_attrs)  # for Portrait
 
-    wm_obj = PdfFileReader(wm_file)
+    wm_obj = PdfFileReader(io.BytesIO(wm_data))
     wm_page = wm_obj.getPage(0)
 
     for page_num in range(pdf_reader.numPages):
@@ -243,25 +326,109 @@ def merge_watermark(pdf_file, save_dir, owner_pwd, p_value, wm_attrs):
         current_page.mergePage(wm_page)
         pdf_writer.addPage(current_page)
 
-    if owner_pwd.lower() not in ['-1', 'no', 'none', 'null']:
+    if need_encrypt(owner_pwd):
         pdf_writer.encrypt('', ownerPwd=owner_pwd, P=p_value)
-        key_file = os.path.join(wm_attrs['out_dir'], '..', 'permission_key')
-        old_keys = None
-        if os.path.exists(key_file):
-            old_key_file = open(key_file, 'r', encoding='utf-8')
-            old_keys = old_key_file.readlines()
-            old_key_file.close()
-
-        with open(key_file, 'w', encoding='utf-8') as f_log:
-            if old_keys is not None:
-                f_log.writelines(old_keys[-1000:])
-            f_log.write('%s %s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), os.path.relpath(out_file), owner_pwd))
 
     pdf_writer.write()
     pdf_writer.close()
 
-    if os.path.exists(wm_file):
-        os.remove(wm_file)
+    return out_file
+
+
+def read_pdf_data(pdf_file):
+    file_stat = os.stat(pdf_file)
+    data_key = (pdf_file, file_stat.st_mtime, file_stat.st_size)
+    if data_key not in PDF_DATA_CACHE:
+        with open(pdf_file, 'rb') as f:
+            PDF_DATA_CACHE[data_key] = f.read()
+        if len(PDF_DATA_CACHE) > PDF_DATA_CACHE_SIZE:
+            PDF_DATA_CACHE.popitem(last=False)
+    PDF_DATA_CACHE.move_to_end(data_key)
+    return PDF_DATA_CACHE[data_key]
+
+
+def stamp_pdf_file(pdf_file, out_file, owner_pwd, p_value, wm_attrs):
+    # run in the worker process, the pdf content is read once per process and every variant parses its own pages
+    return stamp_pdf(PdfFileReader(io.BytesIO(read_pdf_data(pdf_file))), out_file, owner_pwd, p_value, wm_attrs)
+
+
+def merge_watermark(pdf_file, save_dir, owner_pwd, p_value, wm_attrs):
+    out_file = os.path.join(save_dir, os.path.basename(pdf_file))
+
+    pdf_reader = load_pdf(pdf_file)
+    stamp_pdf(pdf_reader, out_file, owner_pwd, p_value, wm_attrs)
+
+    if need_encrypt(owner_pwd):
+        key_file = os.path.join(wm_attrs['out_dir'], '..', 'permission_key')
+        write_permission_key(key_file, out_file, owner_pwd)
+
+    return out_file
+
+
+def merge_watermark_multi(pdf_file, save_dir, recipients, p_value, wm_attrs, executor):
+    """
+    stamp one pdf file for every recipient in parallel, the variants are saved to out_dir/recipient_name/...
+    the first recipient is stamped here with the reader used to check the pdf file,
+    the others are stamped by the executor, which reads the pdf file from disk.
+    the output file or the failed pdf file is recorded in every recipient,
+    BrokenProcessPool is raised after all the finished variants are recorded.
+    """
+    pdf_reader = load_pdf(pdf_file)  # repair the pdf file once if needed
+
+    rel_save_dir = os.path.relpath(save_dir, wm_attrs['out_dir'])
+    task_list = []
+    for recipient in recipients:
+        recipient_save_dir = os.path.join(wm_attrs['out_dir'], recipient['name'], rel_save_dir)
+        if not os.path.exists(recipient_save_dir):
+            os.makedirs(recipient_save_dir)
+        out_file = os.path.join(recipient_save_dir, os.path.basename(pdf_file))
+
+        recipient_wm_attrs = dict(wm_attrs)
+        recipient_wm_attrs['content'] = recipient['content']
+        task_list.append((recipient, out_file, recipient_wm_attrs))
+
+    future_list = []
+    pool_broken = False
+    for recipient, out_file, recipient_wm_attrs in task_list[1:]:
+        try:
+            future = executor.submit(stamp_pdf_file, pdf_file, out_file, recipient['owner_pwd'], p_value,
+                                     recipient_wm_attrs)
+        except BrokenProcessPool:
+            pool_broken = True
+            break
+        future_list.append((future, recipient))
+
+    result_list = []
+    recipient, out_file, recipient_wm_attrs = task_list[0]
+    try:
+        result_list.append((recipient, stamp_pdf(pdf_reader, out_file, recipient['owner_pwd'], p_value,
+                                                 recipient_wm_attrs), None))
+    except Exception as e:
+        result_list.append((recipient, None, e))
+    for future, recipient in future_list:
+        try:
+            result_list.append((recipient, future.result(), None))
+        except BrokenProcessPool:
+            pool_broken = True
+        except Exception as e:
+            result_list.append((recipient, None, e))
+
+    out_list = []
+    for recipient, out_file, error in result_list:
+        if error is not None:
+            print('failed to add watermark %s for %s' % (pdf_file, recipient['name']), error)
+            recipient['failure_list'].append(pdf_file)
+            continue
+        if need_encrypt(recipient['owner_pwd']):
+            key_file = os.path.join(wm_attrs['out_dir'], '..', 'permission_key')
+            write_permission_key(key_file, out_file, recipient['owner_pwd'])
+        recipient['out_files'].append(out_file)
+        out_list.append(out_file)
+
+    if pool_broken:
+        raise BrokenProcessPool('the stamp processes terminated while adding watermark for %s' % pdf_file)
+
+    return out_list
 
 
 def listFiles(dir, out_list, types, recursion=False):
@@ -278,52 +445,67 @@ def listFiles(dir, out_list, types, recursion=False):
     return out_list
 
 
-def add_watermark(input_file,
-                  out_dir,
-                  watermark='WATERMARK',
-                  angle=0,
-                  font_file=None,
-                  font_size=None,
-                  color=[0, 0, 0],
-                  alpha=0.2,
-                  only_pdf=False,
-                  with_date=True,
-                  owner_pwd='',
-                  p_value=-2044):
-    input_file = os.path.abspath(input_file)
-    out_dir = os.path.abspath(out_dir)
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
+def get_wm_content(watermark, with_date):
     wm_content = watermark
     if with_date:
         date_str = time.strftime('%Y.%m.%d')
         wm_content += '|' + date_str
+    return wm_content
 
-    input_file_list = []
-    if os.path.isdir(input_file):
-        listFiles(input_file, input_file_list, OFFICE_PDF_EXT, True)
-        watermark_dir = os.path.join(out_dir, '%s-wm-files' % os.path.basename(input_file))
-        pdf_dir = os.path.join(out_dir, '%s-pdf-files' % os.path.basename(input_file))
-    else:
-        input_file_ext = os.path.splitext(os.path.basename(input_file))[1].lower()
-        assert input_file_ext in OFFICE_PDF_EXT, 'Do not support %s file' % input_file_ext
-        input_file_list = [input_file]
-        watermark_dir = os.path.join(out_dir, 'wm-files')
-        pdf_dir = os.path.join(out_dir, 'pdf-files')
-    wm_attrs = {
-        'content': wm_content,
-        'out_dir': out_dir,
-        'angle': angle,
-        'pagesize': None,
-        'font_file': font_file,
-        'font_size': font_size,
-        'color': color,
-        'alpha': alpha,
-    }
 
-    pdf_convert = PdfConvert()
+def parse_recipients(recipients, with_date, owner_pwd):
+    """
+    fill the default name, content and owner password of every recipient,
+    the name is used as a directory in out_dir, so it is cleaned and should be unique
+    """
+    recipient_list = []
+    name_set = set()
+    for i, recipient in enumerate(recipients):
+        assert isinstance(recipient.get('watermark'), str), 'recipient %d has no watermark' % i
+        recipient_pwd = recipient.get('owner_pwd') or owner_pwd
+        assert isinstance(recipient_pwd, str), 'owner_pwd of recipient %d should be a string' % i
+        if recipient_pwd.lower() == 'random':
+            recipient_pwd = uuid.uuid4().hex
+        recipient_name = recipient.get('name')
+        if not recipient_name:
+            recipient_name = '%d_%s' % (i, recipient['watermark'])
+        assert isinstance(recipient_name, str), 'name of recipient %d should be a string' % i
+        recipient_name = re.sub(r'[\\/:*?"<>|]', '_', recipient_name).strip(' .')
+        assert recipient_name, 'name of recipient %d is empty' % i
+        assert recipient_name.lower() not in name_set, 'duplicate recipient name %s' % recipient_name
+        name_set.add(recipient_name.lower())
+        recipient_list.append({
+            'name': recipient_name,
+            'content': get_wm_content(recipient['watermark'], with_date),
+            'owner_pwd': recipient_pwd,
+            'out_files': [],
+            'failure_list': [],
+        })
+    return recipient_list
+
+
+def load_recipients(recipients_file):
+    """
+    read recipients from a csv file, every line is: watermark[,owner_pwd[,name]]
+    """
+    recipients = []
+    with open(recipients_file, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip():
+                continue
+            recipient = {'watermark': row[0].strip()}
+            if len(row) > 1 and row[1].strip():
+                recipient['owner_pwd'] = row[1].strip()
+            if len(row) > 2 and row[2].strip():
+                recipient['name'] = row[2].strip()
+            recipients.append(recipient)
+    return recipients
+
+
+def watermark_files(input_file, input_file_list, watermark_dir, pdf_dir, only_pdf, owner_pwd, p_value, wm_attrs,
+                    pdf_convert, recipients=None, executor=None, force_convert=False):
     pdf_list = []
+    out_list = []
     failure_list = []
     for src_file in tqdm(input_file_list):
         src_file = os.path.normpath(src_file)
@@ -356,7 +538,7 @@ def add_watermark(input_file,
             left_try_times = TRY_TIMES
             while left_try_times > 0:
                 try:
-                    pdf_list = pdf_convert.run_convert(src_file, pdf_save_dir)
+                    pdf_list = pdf_convert.run_convert(src_file, pdf_save_dir, force_convert)
                     if pdf_list is not None and len(pdf_list) > 0:
                         if left_try_times != TRY_TIMES:
                             print('Try to convert and result success!', left_try_times)
@@ -365,7 +547,9 @@ def add_watermark(input_file,
                     left_try_times -= 1
 
         if pdf_list is not None:
-            if not only_pdf:
+            if only_pdf:
+                out_list.extend(pdf_list)
+            else:
                 try:
                     for pdf_item in pdf_list:
                         tmp_wm_save_dir = watermark_save_dir
@@ -375,9 +559,17 @@ def add_watermark(input_file,
                             if not os.path.exists(tmp_wm_save_dir):
                                 os.makedirs(tmp_wm_save_dir)
 
-                        merge_watermark(pdf_item, tmp_wm_save_dir, owner_pwd, p_value,
-                                        wm_attrs)  # add watermark, overwrite the pdf file
-
+                        if recipients:
+                            out_list.extend(
+                                merge_watermark_multi(pdf_item, tmp_wm_save_dir, recipients, p_value, wm_attrs,
+                                                      executor))
+                        else:
+                            out_file = merge_watermark(pdf_item, tmp_wm_save_dir, owner_pwd, p_value,
+                                                       wm_attrs)  # add watermark, overwrite the pdf file
+                            out_list.append(out_file)
+
+                except BrokenProcessPool:
+                    raise
                 except Exception as e:
                     print('failed to add watermark %s' % src_file, e)
                     failure_list.append(src_file)
@@ -385,13 +577,102 @@ def add_watermark(input_file,
         else:
             failure_list.append(src_file)
 
-    pdf_convert.close()
+    return out_list, failure_list
+
+
+def add_watermark(input_file,
+                  out_dir,
+                  watermark='WATERMARK',
+                  angle=0,
+                  font_file=None,
+                  font_size=None,
+                  color='black',
+                  alpha=0.2,
+                  only_pdf=False,
+                  with_date=True,
+                  owner_pwd='',
+                  p_value=-2044,
+                  pdf_convert=None,
+                  recipients=None,
+                  process_num=4,
+                  executor=None,
+                  job_id=None):
+    """
+    add watermark for a file or all files in a directory,
+    return the list of output files, the list of failed source files and the recipients.
+    pdf_convert can be passed in to reuse the office applications between calls, it is not closed here.
+    recipients is a list of dict with keys watermark, owner_pwd(optional) and name(optional),
+    owner_pwd is the default password of recipients, random gives every recipient a different one,
+    every file is converted once and stamped for all recipients by process_num processes,
+    or by executor if it is passed in, it is not shut down here.
+    the returned recipients have their name, owner_pwd, out_files and failure_list.
+    job_id isolates the files of concurrent jobs in the same out_dir, the files are always converted again
+    and saved to the job_id sub directory of wm-files.
+    """
+    input_file = os.path.abspath(input_file)
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    assert is_valid_color(color), 'Do not support color %s' % color
+    wm_content = get_wm_content(watermark, with_date)
+
+    input_file_list = []
+    if os.path.isdir(input_file):
+        listFiles(input_file, input_file_list, OFFICE_PDF_EXT, True)
+        watermark_dir = os.path.join(out_dir, '%s-wm-files' % os.path.basename(input_file))
+        pdf_dir = os.path.join(out_dir, '%s-pdf-files' % os.path.basename(input_file))
+    else:
+        input_file_ext = os.path.splitext(os.path.basename(input_file))[1].lower()
+        assert input_file_ext in OFFICE_PDF_EXT, 'Do not support %s file' % input_file_ext
+        input_file_list = [input_file]
+        watermark_dir = os.path.join(out_dir, 'wm-files')
+        pdf_dir = os.path.join(out_dir, 'pdf-files')
+    if job_id is not None:
+        watermark_dir = os.path.join(watermark_dir, job_id)
+        pdf_dir = os.path.join(pdf_dir, job_id)
+    wm_attrs = {
+        'content': wm_content,
+        'out_dir': out_dir,
+        'angle': angle,
+        'pagesize': None,
+        'font_file': font_file,
+        'font_size': font_size,
+        'color': color,
+        'alpha': alpha,
+    }
+
+    close_convert = pdf_convert is None
+    if close_convert:
+        pdf_convert = PdfConvert()
+    if recipients:
+        recipients = parse_recipients(recipients, with_date, owner_pwd)
+    close_executor = bool(recipients) and not only_pdf and executor is None
+    if close_executor:
+        executor = ProcessPoolExecutor(max_workers=process_num)
+    try:
+        out_list, failure_list = watermark_files(input_file, input_file_list, watermark_dir, pdf_dir, only_pdf,
+                                                 owner_pwd, p_value, wm_attrs, pdf_convert, recipients, executor,
+                                                 job_id is not None)
+    finally:
+        if close_convert:
+            pdf_convert.close()
+        if close_executor:
+            executor.shutdown()
+        if job_id is not None and not only_pdf:
+            shutil.rmtree(pdf_dir, ignore_errors=True)
+
     print('failure list:')
     for i, failure_file in enumerate(failure_list):
         print(i, failure_file)
+    for recipient in recipients or []:
+        for failure_file in recipient['failure_list']:
+            print(recipient['name'], failure_file)
     # if not only_pdf:
     #     shutil.rmtree(pdf_dir)
 
+    return out_list, failure_list, recipients
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -414,6 +695,13 @@ def parse_args():
         type=int,
         help='permission value, default(-4092/-2044) permit print only, -1 permit everything, -4096 deny anything',
         default=-2044)
+    # fan-out params
+    parser.add_argument(
+        '--recipients',
+        type=str,
+        help='csv file, every line is watermark[,owner_pwd[,name]], stamp a variant for every recipient',
+        default=None)
+    parser.add_argument('--process_num', type=int, help='processes for stamping recipient variants', default=4)
     args = parser.parse_args()
 
     return args
@@ -425,7 +713,8 @@ if __name__ == '__main__':
     out_dir = args.out_dir
     owner_pwd = args.pwd
 
-    if owner_pwd.lower() == 'random':
+    # with recipients, random is resolved for every recipient
+    if owner_pwd.lower() == 'random' and args.recipients is None:
         owner_pwd = uuid.uuid4().hex
 
     wm_attrs = {
@@ -440,5 +729,8 @@ if __name__ == '__main__':
         'owner_pwd': owner_pwd,
         'p_value': args.p,
     }
+    if args.recipients is not None:
+        wm_attrs['recipients'] = load_recipients(args.recipients)
+        wm_attrs['process_num'] = args.process_num
 
     add_watermark(input_file, out_dir, **wm_attrs)
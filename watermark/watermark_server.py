@@ -0,0 +1,268 @@
+import os
+import json
+import queue
+import argparse
+import threading
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import comtypes
+from add_watermark import PdfConvert, add_watermark, is_valid_color
+
+JOB_PARAMS = [
+    'input_file',
+    'out_dir',
+    'watermark',
+    'angle',
+    'font_file',
+    'font_size',
+    'color',
+    'alpha',
+    'only_pdf',
+    'with_date',
+    'owner_pwd',
+    'p_value',
+    'recipients',
+]
+PATH_PARAMS = ['input_file', 'out_dir', 'font_file']
+MAX_CONTENT_LENGTH = 1024 * 1024
+
+
+class WatermarkJob(object):
+
+    def __init__(self, params):
+        self.job_id = uuid.uuid4().hex
+        self.params = params
+        self.result = None
+        self.done = threading.Event()
+
+
+class WatermarkService(object):
+    """
+    keep the office applications and registered fonts alive between jobs,
+    every worker thread owns one PdfConvert because the COM objects can not be shared between threads.
+    the recipient variants of all jobs are stamped by one shared process pool, it is replaced when broken.
+    """
+
+    def __init__(self, roots, worker_num=2, process_num=4, default_params=None):
+        self.job_queue = queue.Queue()
+        self.process_num = process_num
+        self.executor = ProcessPoolExecutor(max_workers=process_num)
+        self.executor_lock = threading.Lock()
+        self.roots = [os.path.normcase(os.path.realpath(root)) for root in roots]
+        self.default_params = default_params or {}
+        self.workers = []
+        for i in range(worker_num):
+            worker = threading.Thread(target=self.run_worker, args=(i, ), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def in_roots(self, path):
+        path = os.path.normcase(os.path.realpath(path))
+        for root in self.roots:
+            try:
+                if os.path.commonpath([root, path]) == root:
+                    return True
+            except ValueError:  # on different drives
+                continue
+        return False
+
+    def submit(self, params):
+        if not isinstance(params, dict):
+            raise ValueError('params should be a json object')
+        unknown_params = [k for k in params if k not in JOB_PARAMS]
+        if unknown_params:
+            raise ValueError('unknown params %s' % ', '.join(unknown_params))
+        for key in ['input_file', 'out_dir']:
+            if key not in params:
+                raise ValueError('%s is required' % key)
+        for key in PATH_PARAMS:
+            if key in params and not isinstance(params[key], str):
+                raise ValueError('%s should be a path' % key)
+        if not self.in_roots(params['input_file']) or \
+                ('font_file' in params and not self.in_roots(params['font_file'])):
+            raise ValueError('input_file and font_file should be inside %s' % ', '.join(self.roots))
+        # the permission_key file is written to the parent of out_dir
+        if not self.in_roots(os.path.dirname(os.path.abspath(params['out_dir']))):
+            raise ValueError('out_dir should be a sub directory of %s' % ', '.join(self.roots))
+        if 'owner_pwd' in params and not isinstance(params['owner_pwd'], str):
+            raise ValueError('owner_pwd should be a string')
+        if 'color' in params and not is_valid_color(params['color']):
+            raise ValueError('unknown color %s' % params['color'])
+
+        job_params = dict(self.default_params)
+        job_params.update(params)
+        # with recipients, random is resolved for every recipient
+        if str(job_params.get('owner_pwd', '')).lower() == 'random' and not job_params.get('recipients'):
+            job_params['owner_pwd'] = uuid.uuid4().hex
+
+        job = WatermarkJob(job_params)
+        self.job_queue.put(job)
+        return job
+
+    def reset_executor(self, broken_executor):
+        with self.executor_lock:
+            if self.executor is broken_executor:
+                self.executor = ProcessPoolExecutor(max_workers=self.process_num)
+        broken_executor.shutdown(wait=False)
+
+    def run_job(self, job, pdf_convert):
+        executor = self.executor
+        try:
+            return add_watermark(pdf_convert=pdf_convert, executor=executor, job_id=job.job_id, **job.params)
+        except BrokenProcessPool:
+            # a stamp process died, e.g. out of memory, run the job again with a new pool
+            traceback.print_exc()
+            self.reset_executor(executor)
+            return add_watermark(pdf_convert=pdf_convert, executor=self.executor, job_id=job.job_id, **job.params)
+
+    def run_worker(self, worker_id):
+        comtypes.CoInitialize()
+        pdf_convert = PdfConvert()
+        try:
+            while True:
+                job = self.job_queue.get()
+                if job is None:
+                    break
+                try:
+                    out_list, failure_list, recipients = self.run_job(job, pdf_convert)
+                    job.result = {
+                        'job_id': job.job_id,
+                        'status': 'failure' if failure_list else 'success',
+                        'out_files': out_list,
+                        'failure_list': failure_list,
+                    }
+                    if recipients:
+                        job.result['recipients'] = [{
+                            'name': recipient['name'],
+                            'owner_pwd': recipient['owner_pwd'],
+                            'out_files': recipient['out_files'],
+                            'failure_list': recipient['failure_list'],
+                        } for recipient in recipients]
+                        if any(recipient['failure_list'] for recipient in recipients):
+                            job.result['status'] = 'failure'
+                    else:
+                        job.result['owner_pwd'] = job.params['owner_pwd']
+                except BrokenProcessPool as e:
+                    traceback.print_exc()
+                    self.reset_executor(self.executor)
+                    job.result = {'job_id': job.job_id, 'status': 'error', 'message': str(e)}
+                except Exception as e:
+                    traceback.print_exc()
+                    job.result = {'job_id': job.job_id, 'status': 'error', 'message': str(e)}
+                finally:
+                    job.done.set()
+        finally:
+            pdf_convert.close()
+            comtypes.CoUninitialize()
+
+    def close(self):
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.executor.shutdown()
+
+
+class WatermarkHandler(BaseHTTPRequestHandler):
+    service = None
+    allowed_hosts = []
+
+    def send_json(self, code, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_host(self):
+        # reject requests through other host names, e.g. dns rebinding from web pages
+        if self.headers.get('Host') not in self.allowed_hosts:
+            self.send_json(403, {'status': 'error', 'message': 'forbidden host'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.check_host():
+            return
+        if self.path != '/status':
+            self.send_json(404, {'status': 'error', 'message': 'not found'})
+            return
+        self.send_json(200, {
+            'status': 'running',
+            'workers': len(self.service.workers),
+            'pending_jobs': self.service.job_queue.qsize(),
+        })
+
+    def do_POST(self):
+        if not self.check_host():
+            return
+        if self.path != '/watermark':
+            self.send_json(404, {'status': 'error', 'message': 'not found'})
+            return
+        # browsers can not send application/json to other origins without a preflight request
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.send_json(415, {'status': 'error', 'message': 'Content-Type should be application/json'})
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_json(400, {'status': 'error', 'message': 'invalid Content-Length'})
+            return
+        if content_length < 0:
+            self.send_json(400, {'status': 'error', 'message': 'invalid Content-Length'})
+            return
+        if content_length > MAX_CONTENT_LENGTH:
+            self.send_json(413, {'status': 'error', 'message': 'request body is too large'})
+            return
+        try:
+            params = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            job = self.service.submit(params)
+        except Exception as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+
+        job.done.wait()
+        self.send_json(200 if job.result['status'] != 'error' else 500, job.result)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, help='only listen on localhost by default', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='', default=8765)
+    parser.add_argument('--workers', type=int, help='number of jobs processed concurrently', default=2)
+    parser.add_argument('--process_num', type=int, help='processes for stamping recipient variants', default=4)
+    parser.add_argument('--font_file', type=str, help='default font file for jobs', default='arial.ttf')
+    parser.add_argument('--pwd', type=str, help='default owner password for jobs, random for a new one per job',
+                        default='ccb123456')
+    parser.add_argument(
+        '--root',
+        type=str,
+        action='append',
+        help='directory that jobs can read and write, can be set more than once, default is current directory')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    roots = args.root or [os.getcwd()]
+    default_params = {'angle': 45, 'font_file': args.font_file, 'color': 'black', 'owner_pwd': args.pwd}
+    service = WatermarkService(roots, args.workers, args.process_num, default_params=default_params)
+    WatermarkHandler.service = service
+    WatermarkHandler.allowed_hosts = ['%s:%d' % (host, args.port) for host in ['127.0.0.1', 'localhost', args.host]]
+    server = ThreadingHTTPServer((args.host, args.port), WatermarkHandler)
+    print('watermark service listening on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()